@@ -11,8 +11,11 @@ indentation hardcoded.
 https://forum.sublimetext.com/t/syntax-definition-explicitly-specify-backref-context/60899
 """
 
+import argparse
 import functools
+import hashlib
 import yaml
+from collections import deque
 from pathlib import Path
 from typing import Any, NamedTuple, Optional
 
@@ -21,27 +24,107 @@ TEMPLATE = HERE / "Haskell-Syntax.template.sublime-syntax"
 OUTPUT = HERE / "src" / "Haskell-Syntax.sublime-syntax"
 
 MAX_INDENTATION = 40
-INDENTATIONS = list(range(0, MAX_INDENTATION + 1))[::-1]
+# Deepest first. Order matters: patterns are expanded in this order, and
+# e.g. '^(\s{2})' also matches a line indented by 4, so deeper indentations
+# have to be tried first.
+INDENTATIONS = tuple(range(MAX_INDENTATION, -1, -1))
+
+# regexes matching exactly `i` whitespace characters, indexed by `i`
+INDENT_REGEXES = tuple(r"\s{%d}" % i for i in range(MAX_INDENTATION + 1))
 
 INDENTATION_MARKER = "{{INDENTATION}}"
 
+# what to replace INDENTATION_MARKER with, indexed by indentation;
+# special case; '\s{0}' doesn't seem to work here
+INDENTATION_MARKER_REGEXES = (r"(?!\s)",) + INDENT_REGEXES[1:]
+
+# the generated "pop_when_deindent" contexts, indexed by indentation
+POP_WHEN_DEINDENT_PATTERNS = {
+    i: [
+        {
+            "match": r"^(?!%s\s)" % INDENT_REGEXES[i],
+            "pop": True,
+        },
+    ]
+    for i in INDENTATIONS
+}
+
 Pattern = dict
 Patterns = list[Pattern]
 ContextName = str
 BranchLabel = str
 
-def main():
+def main(*, force: bool = False) -> None:
+    # skip regenerating if nothing changed since the last run
+    input_hash = get_input_hash()
+    if not force and read_output_stamp() == input_hash:
+        return
+
     # read in old data
     data = decode_yaml(TEMPLATE.read_text())
 
-    # find all indented contexts
-    indented_contexts = IndentedContexts.load(data)
+    # find everything each pattern references, once up front
+    pattern_references = {
+        id(pattern): PatternVisitorGetReferences.run(pattern)
+        for patterns in data["contexts"].values()
+        for pattern in patterns
+    }
 
-    _pattern_with_indent = functools.partial(
-        PatternVisitorIndent.run,
-        contexts_to_duplicate=indented_contexts.names,
-        branch_points_to_duplicate=indented_contexts.branch_points,
-    )
+    # find all indented contexts
+    indented_contexts = IndentedContexts.load(data, pattern_references)
+
+    # patterns that don't reference any indented contexts or branch points
+    # are the same at every indentation, so they can be reused as-is
+    def _is_invariant(references):
+        if not indented_contexts.names.isdisjoint(references.subcontexts):
+            return False
+        return indented_contexts.branch_points.isdisjoint(references.branch_labels)
+
+    invariant_patterns = {
+        pattern_id
+        for pattern_id, references in pattern_references.items()
+        if _is_invariant(references)
+    }
+
+    context_renames = get_indent_renames(indented_contexts.names)
+    branch_label_renames = get_indent_renames(indented_contexts.branch_points)
+
+    def _pattern_with_indent(pattern, indent):
+        if id(pattern) in invariant_patterns:
+            return pattern
+        return PatternVisitorIndent.run(
+            pattern,
+            indent,
+            context_renames=context_renames,
+            branch_label_renames=branch_label_renames,
+        )
+
+    # A pattern matching INDENTATION_MARKER expands into one pattern per
+    # indentation, which doesn't depend on the indentation of the context
+    # it's in, so expand each one once and reuse it in every copy of the
+    # context. This relies on marker expansion ignoring the context's own
+    # indentation; see the TODO in the loop below.
+    marker_expansions: dict[int, Patterns] = {}
+    def _expand_indentation_marker(pattern):
+        expansion = marker_expansions.get(id(pattern))
+        if expansion is not None:
+            return expansion
+
+        expansion = []
+        # scan the match for markers once, then fill in each indentation;
+        # only marker patterns get here, so the match is always set
+        pattern_match = PatternFields.of(pattern).match or ""
+        match_parts = pattern_match.split(INDENTATION_MARKER)
+        for indent_inner in INDENTATIONS:
+            new_pattern = _pattern_with_indent(pattern, indent_inner)
+            # the original pattern is shared, so only modify a copy of it
+            if new_pattern is pattern:
+                new_pattern = pattern.copy()
+            new_pattern["match"] = INDENTATION_MARKER_REGEXES[indent_inner].join(match_parts)
+            expansion.append(new_pattern)
+
+        marker_expansions[id(pattern)] = expansion
+        return expansion
 
     new_contexts = {}
     def _add_new_context(context_name, indent, patterns):
@@ -53,31 +136,30 @@ def main():
     for context, patterns in data["contexts"].items():
         # duplicate "pop_when_deindent" manually
         if context == "pop_when_deindent":
-            for i in INDENTATIONS:
-                _add_new_context(context, i, [
-                    {
-                        "match": r"^(?!%s\s)" % indent_regex(i),
-                        "pop": True,
-                    },
-                ])
+            for i, pop_patterns in POP_WHEN_DEINDENT_PATTERNS.items():
+                _add_new_context(context, i, pop_patterns)
             continue
 
-        indentations = INDENTATIONS if context in indented_contexts.names else [None]
+        # check for markers once, instead of in every copy of the context
+        patterns_have_marker = [
+            PatternFields.of(pattern).has_indentation_marker
+            for pattern in patterns
+        ]
+
+        # contexts that aren't indented and have no markers to expand are
+        # copied over as-is
+        if context not in indented_contexts.names and not any(patterns_have_marker):
+            _add_new_context(context, None, patterns)
+            continue
+
+        indentations = INDENTATIONS if context in indented_contexts.names else (None,)
         for indent in indentations:
             new_patterns = []
 
-            for pattern in patterns:
-                pattern_match = pattern.get("match", "")
-                if INDENTATION_MARKER in pattern_match:
+            for pattern, has_marker in zip(patterns, patterns_have_marker):
+                if has_marker:
                     # TODO(nested-indent): handle when `indent is not None`
-                    for indent_inner in INDENTATIONS:
-                        new_pattern = _pattern_with_indent(pattern, indent_inner)
-                        new_pattern["match"] = pattern_match.replace(
-                            INDENTATION_MARKER,
-                            # special case; '\s{0}' doesn't seem to work here
-                            r"(?!\s)" if indent_inner == 0 else indent_regex(indent_inner),
-                        )
-                        new_patterns.append(new_pattern)
+                    new_patterns.extend(_expand_indentation_marker(pattern))
                 else:
                     new_pattern = _pattern_with_indent(pattern, indent)
                     new_patterns.append(new_pattern)
@@ -86,19 +168,70 @@ def main():
 
     # write out new data
     data["contexts"] = new_contexts
-    OUTPUT.write_text(encode_yaml(data))
+    write_output(data, input_hash)
+
+### Output stamp ###
+
+# OUTPUT records a hash of the inputs it was generated from in a comment
+# right after the YAML header
+OUTPUT_STAMP_PREFIX = "input hash: "
+
+def get_input_hash() -> str:
+    # the output depends on both the template and this script; normalize
+    # line endings so checkouts with CRLF line endings get the same hash
+    input_hash = hashlib.blake2b(digest_size=16)
+    for path in [TEMPLATE, Path(__file__)]:
+        input_hash.update(path.read_bytes().replace(b"\r\n", b"\n"))
+    return input_hash.hexdigest()
+
+def read_output_stamp() -> Optional[str]:
+    try:
+        with OUTPUT.open(encoding="utf-8") as f:
+            header = [f.readline() for _ in range(3)]
+    except FileNotFoundError:
+        return None
+
+    stamp_line = header[2].rstrip("\n")
+    stamp_prefix = "# " + OUTPUT_STAMP_PREFIX
+    if not stamp_line.startswith(stamp_prefix):
+        return None
+    return stamp_line[len(stamp_prefix):]
+
+# OUTPUT is written here first, then moved into place. If writing is
+# interrupted, OUTPUT is never left truncated with a valid stamp, which
+# would make later runs skip regenerating it.
+OUTPUT_TMP = OUTPUT.with_name(OUTPUT.name + ".tmp")
+
+def write_output(data: dict, input_hash: str) -> None:
+    try:
+        with OUTPUT_TMP.open("w", encoding="utf-8", newline="\n") as f:
+            encode_yaml(data, f, comment=OUTPUT_STAMP_PREFIX + input_hash)
+        OUTPUT_TMP.replace(OUTPUT)
+    except BaseException:
+        OUTPUT_TMP.unlink(missing_ok=True)
+        raise
 
 ### Indentation strings ###
 
+# names that are left as-is instead of getting an indentation suffix
+# TODO(nested-indent): remove workaround
+NAMES_WITHOUT_INDENT = frozenset({"function"})
+
+@functools.lru_cache(maxsize=None)
 def name_with_indent(name: str, indent: int) -> str:
-    # TODO(nested-indent): remove workaround
-    if name == "function":
+    if name in NAMES_WITHOUT_INDENT:
         return name
 
     return f"{name}__{indent}"
 
-def indent_regex(indent: int) -> str:
-    return r"\s{%d}" % indent
+# A mapping from indentation to a mapping of names to their indented names
+IndentRenames = dict[int, dict[str, str]]
+
+def get_indent_renames(names: frozenset[str]) -> IndentRenames:
+    return {
+        indent: {name: name_with_indent(name, indent) for name in names}
+        for indent in INDENTATIONS
+    }
 
 ### Finding indented contexts ###
 
@@ -108,53 +241,57 @@ def indent_regex(indent: int) -> str:
 # context.
 #
 # None if we're currently along a path that isn't indented yet
-IndentedContextPath = Optional[list[ContextName]]
+IndentedContextPath = Optional[tuple[ContextName, ...]]
 
 class IndentedContexts(NamedTuple):
-    names: set[ContextName]
-    branch_points: set[BranchLabel]
+    names: frozenset[ContextName]
+    branch_points: frozenset[BranchLabel]
 
     @classmethod
-    def load(cls, data: dict) -> "IndentedContexts":
+    def load(
+        cls,
+        data: dict,
+        pattern_references: dict[int, "PatternReferences"],
+    ) -> "IndentedContexts":
         indented_context_names = {"pop_when_deindent"}
         context_to_branch_point = {}
 
-        context_queue: list[tuple[ContextName, IndentedContextPath]] = [
+        context_queue: deque[tuple[ContextName, IndentedContextPath]] = deque([
             ("main", None),
             ("prototype", None),
-        ]
+        ])
         seen = set()
         while len(context_queue) > 0:
-            context, path = context_queue.pop(0)
+            context, path = context_queue.popleft()
 
             if context in indented_context_names:
-                indented_context_names.update(path or [])
+                indented_context_names.update(path or ())
                 continue
 
             # check cycles
-            node = (context, None if path is None else tuple(path))
+            node = (context, path)
             if (node in seen) or (path and context in path):
                 continue
             seen.add(node)
 
-            path = None if path is None else path + [context]
+            path = None if path is None else path + (context,)
             for pattern in data["contexts"][context]:
-                branch_point = pattern.get("branch_point")
-                if branch_point:
-                    context_to_branch_point[context] = branch_point
+                fields = PatternFields.of(pattern)
+                if fields.branch_point:
+                    context_to_branch_point[context] = fields.branch_point
 
                 # TODO(nested-indent): when matching indentation within indented context,
                 # nest indentation indicators; e.g. `function_signature_start__2__4`, so
                 # that we can use 'function__2' as a branch point
                 next_path: IndentedContextPath
-                if INDENTATION_MARKER in pattern.get("match", "") and path is None:
-                    next_path = []
+                if fields.has_indentation_marker and path is None:
+                    next_path = ()
                 else:
                     next_path = path
 
                 context_queue.extend(
                     (subcontext, next_path)
-                    for subcontext in PatternVisitorGetSubcontexts.run(pattern)
+                    for subcontext in pattern_references[id(pattern)].subcontexts
                 )
 
         branch_points = {
@@ -163,11 +300,79 @@ class IndentedContexts(NamedTuple):
             if context in context_to_branch_point
         }
 
-        return cls(indented_context_names, branch_points)
+        return cls(frozenset(indented_context_names), frozenset(branch_points))
 
 ### Pattern ###
 
+# The value of "push" or "set" in a pattern, classified once when the
+# pattern is first parsed.
+class NextContexts(NamedTuple):
+    # one of "name", "names", or "patterns"
+    kind: str
+    value: Any
+
+    @classmethod
+    def parse(cls, value: Any) -> Optional["NextContexts"]:
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return cls("name", value)
+        # a list is either all context names or all patterns, so only
+        # the first element needs to be checked
+        if len(value) == 0 or isinstance(value[0], str):
+            return cls("names", value)
+        return cls("patterns", value)
+
+# The fields of a pattern that the generator looks at, read out of the
+# pattern dict once and reused every time the pattern is visited.
+class PatternFields(NamedTuple):
+    include: Optional[ContextName]
+    match: Optional[str]
+    has_indentation_marker: bool
+    embed: Optional[ContextName]
+    branch: Optional[list[ContextName]]
+    branch_point: Optional[BranchLabel]
+    fail: Optional[BranchLabel]
+    push: Optional[NextContexts]
+    set: Optional[NextContexts]
+
+    @classmethod
+    def of(cls, pattern: Pattern) -> "PatternFields":
+        cached = PATTERN_FIELDS_CACHE.get(id(pattern))
+        if cached is None:
+            cached = (pattern, cls.parse(pattern))
+            PATTERN_FIELDS_CACHE[id(pattern)] = cached
+        return cached[1]
+
+    @classmethod
+    def parse(cls, pattern: Pattern) -> "PatternFields":
+        pattern_match = pattern.get("match")
+
+        # everything besides "include" only applies to "match" patterns
+        def _get_match_field(key):
+            return pattern.get(key) if pattern_match else None
+
+        return cls(
+            include=pattern.get("include"),
+            match=pattern_match,
+            has_indentation_marker=INDENTATION_MARKER in (pattern_match or ""),
+            embed=_get_match_field("embed"),
+            branch=_get_match_field("branch"),
+            branch_point=_get_match_field("branch_point"),
+            fail=_get_match_field("fail"),
+            push=NextContexts.parse(_get_match_field("push")),
+            set=NextContexts.parse(_get_match_field("set")),
+        )
+
+# id(pattern) -> (pattern, fields). Holding onto the pattern keeps it
+# alive, so its id can't be reused by a different dict.
+PATTERN_FIELDS_CACHE: dict[int, tuple[Pattern, PatternFields]] = {}
+
+# visitors are created for every pattern they visit, so give them
+# __slots__ instead of a per-instance __dict__
 class PatternVisitor:
+    __slots__ = ()
+
     def on_subcontext(self, subcontext: ContextName) -> Any:
         return subcontext
 
@@ -175,100 +380,173 @@ class PatternVisitor:
         return branch_label
 
     def _run(self, pattern: Pattern) -> dict:
-        new_pattern = {}
-
-        pattern_include = pattern.get("include")
-        if pattern_include:
-            new_pattern["include"] = self.on_subcontext(pattern_include)
-
-        pattern_match = pattern.get("match")
-        if pattern_match:
-            pattern_embed = pattern.get("embed")
-            if pattern_embed:
-                new_pattern["embed"] = self.on_subcontext(pattern_embed)
-
-            pattern_branches = pattern.get("branch")
-            if pattern_branches:
-                new_pattern["branch"] = [
-                    self.on_subcontext(pattern_branch)
-                    for pattern_branch in pattern_branches
-                ]
-
-            branch_point = pattern.get("branch_point")
-            if branch_point:
-                new_pattern["branch_point"] = self.on_branch_label(branch_point)
-
-            branch_fail = pattern.get("fail")
-            if branch_fail:
-                new_pattern["fail"] = self.on_branch_label(branch_fail)
-
-            for key in ["push", "set"]:
-                pattern_next = pattern.get(key)
-                if pattern_next is None:
-                    continue
-                if isinstance(pattern_next, str):
-                    new_pattern[key] = self.on_subcontext(pattern_next)
-                elif all(isinstance(p, str) for p in pattern_next):
-                    new_pattern[key] = [self.on_subcontext(p) for p in pattern_next]
+        # Visit nested patterns with an explicit stack instead of recursing.
+        # Work is pushed in reverse, so it's popped in the same order a
+        # recursive walk would visit it: include, embed, branch, branch_point,
+        # fail, then push (including any nested patterns, left to right), then
+        # set. IndentedContexts.load depends on the order subcontexts are
+        # found in, so this order has to be kept. Each entry is one of:
+        #   ("visit", pattern, parent, index): visit a pattern, storing the
+        #       visited version in parent[index]
+        #   ("next", key, pattern_next, new_pattern): visit a push/set field
+        #   ("finish", pattern, new_pattern, parent, index): store the visited
+        #       pattern, once all of its fields have been visited
+        result = [pattern]
+        stack: list[tuple] = [("visit", pattern, result, 0)]
+        while len(stack) > 0:
+            item = stack.pop()
+
+            if item[0] == "visit":
+                _, pattern, parent, index = item
+                new_pattern: dict = {}
+
+                fields = PatternFields.of(pattern)
+
+                if fields.include:
+                    new_pattern["include"] = self.on_subcontext(fields.include)
+
+                if fields.embed:
+                    new_pattern["embed"] = self.on_subcontext(fields.embed)
+
+                if fields.branch:
+                    new_pattern["branch"] = [
+                        self.on_subcontext(pattern_branch)
+                        for pattern_branch in fields.branch
+                    ]
+
+                if fields.branch_point:
+                    new_pattern["branch_point"] = self.on_branch_label(fields.branch_point)
+
+                if fields.fail:
+                    new_pattern["fail"] = self.on_branch_label(fields.fail)
+
+                stack.append(("finish", pattern, new_pattern, parent, index))
+                for key, pattern_next in [("set", fields.set), ("push", fields.push)]:
+                    if pattern_next is not None:
+                        stack.append(("next", key, pattern_next, new_pattern))
+
+            elif item[0] == "next":
+                _, key, pattern_next, new_pattern = item
+                if pattern_next.kind == "name":
+                    new_pattern[key] = self.on_subcontext(pattern_next.value)
+                elif pattern_next.kind == "names":
+                    new_pattern[key] = [self.on_subcontext(p) for p in pattern_next.value]
                 else:
-                    new_pattern[key] = [self._run(p) for p in pattern_next]
+                    # nested patterns store their visited versions in this list
+                    new_patterns_next = list(pattern_next.value)
+                    new_pattern[key] = new_patterns_next
+                    stack.extend(
+                        ("visit", p, new_patterns_next, i)
+                        for i, p in reversed(list(enumerate(pattern_next.value)))
+                    )
+
+            else:
+                _, pattern, new_pattern, parent, index = item
+                # only copy the pattern if visiting it changed anything
+                if any(pattern[k] != v for k, v in new_pattern.items()):
+                    parent[index] = pattern.copy()
+                    parent[index].update(new_pattern)
+
+        return result[0]
+
+# the contexts and branch labels referenced anywhere in a pattern
+class PatternReferences(NamedTuple):
+    subcontexts: list[ContextName]
+    branch_labels: list[BranchLabel]
+
+# collects both subcontexts and branch labels in a single pass
+class PatternVisitorGetReferences(PatternVisitor):
+    __slots__ = ("_subcontexts", "_branch_labels")
 
-        return { **pattern, **new_pattern }
-
-class PatternVisitorGetSubcontexts(PatternVisitor):
     @classmethod
-    def run(cls, pattern: Pattern) -> list[ContextName]:
+    def run(cls, pattern: Pattern) -> PatternReferences:
         visitor = cls()
         visitor._run(pattern)
-        return visitor._subcontexts
+        return PatternReferences(visitor._subcontexts, visitor._branch_labels)
 
     def __init__(self):
         self._subcontexts = []
+        self._branch_labels = []
 
     def on_subcontext(self, subcontext: ContextName):
         self._subcontexts.append(subcontext)
+        return super().on_subcontext(subcontext)
+
+    def on_branch_label(self, branch_label: BranchLabel):
+        self._branch_labels.append(branch_label)
+        return super().on_branch_label(branch_label)
 
 class PatternVisitorIndent(PatternVisitor):
+    __slots__ = ("_context_renames", "_branch_label_renames")
+
     @classmethod
-    def run(cls, pattern: Pattern, indent: Optional[int], **kwargs) -> dict:
+    def run(
+        cls,
+        pattern: Pattern,
+        indent: Optional[int],
+        *,
+        context_renames: IndentRenames,
+        branch_label_renames: IndentRenames,
+    ) -> dict:
         if indent is None:
             return pattern
-        return cls(indent=indent, **kwargs)._run(pattern)
+        return cls(
+            context_renames=context_renames[indent],
+            branch_label_renames=branch_label_renames[indent],
+        )._run(pattern)
 
     def __init__(
         self,
         *,
-        indent: int,
-        contexts_to_duplicate: set[ContextName],
-        branch_points_to_duplicate: set[BranchLabel],
+        context_renames: dict[ContextName, ContextName],
+        branch_label_renames: dict[BranchLabel, BranchLabel],
     ):
-        self._indent = indent
-        self._contexts_to_duplicate = contexts_to_duplicate
-        self._branch_points_to_duplicate = branch_points_to_duplicate
+        self._context_renames = context_renames
+        self._branch_label_renames = branch_label_renames
 
     def on_subcontext(self, context_name: ContextName) -> ContextName:
-        if context_name not in self._contexts_to_duplicate:
-            return super().on_subcontext(context_name)
-        return name_with_indent(context_name, self._indent)
+        return self._context_renames.get(context_name, context_name)
 
     # TODO(nested-indent): generalize this to set indentation of branch_point
     # to the appropriate indentation, instead of the current indentation
     def on_branch_label(self, branch_label: BranchLabel) -> BranchLabel:
-        if branch_label not in self._branch_points_to_duplicate:
-            return super().on_branch_label(branch_label)
-        return name_with_indent(branch_label, self._indent)
+        return self._branch_label_renames.get(branch_label, branch_label)
 
 ### YAML ###
 
+# use the libyaml bindings when available, which are much faster than
+# the pure-Python implementations
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper  # type: ignore
+
+# write out shared objects in full every time, instead of as anchors + aliases
+class NoAliasDumper(YamlDumper):
+    def ignore_aliases(self, data):
+        return True
+
 def decode_yaml(s):
-    return yaml.load(s, Loader=yaml.Loader)
+    return yaml.load(s, Loader=YamlLoader)
 
-def encode_yaml(data):
-    Dumper = yaml.Dumper
-    Dumper.ignore_aliases = lambda self, data: True
-    return "%YAML 1.2\n---\n" + yaml.dump(data, Dumper=Dumper)
+def encode_yaml(data, stream, comment: Optional[str] = None):
+    stream.write("%YAML 1.2\n---\n")
+    if comment is not None:
+        stream.write(f"# {comment}\n")
+    # don't wrap long regexes across lines
+    yaml.dump(data, stream, Dumper=NoAliasDumper, width=10**9)
 
 ### Entrypoint ###
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="regenerate the output even if its inputs haven't changed",
+    )
+    args = parser.parse_args()
+    main(force=args.force)
@@ -17,4 +17,5 @@ fi
 # run typechecking, but don't fail on failures
 "${VENV_DIR}/bin/mypy" . || true
 
-"${VENV_DIR}/bin/python" generate.py
+# pass through arguments, e.g. `./generate.sh --force`
+"${VENV_DIR}/bin/python" generate.py "$@"